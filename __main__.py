@@ -1,14 +1,53 @@
 import sys
-import game
-from expressions import Expression
+from expressions import Expression, differentiate_many
 
-if len(sys.argv) > 1:
-    y = Expression(parse=''.join(sys.argv[1:]))
+def derive(text):
+    y = Expression(parse=text)
     dy = y.differentiate()
     dy.collect_terms()
-    print(str(dy))
-else:
-    game.install_dependencies()
-    import pygame
-    game.play()
-    #game.play((1920, 1080), pygame.FULLSCREEN | pygame.DOUBLEBUF | pygame.HWSURFACE)
+    return str(dy)
+
+def batch(source, jobs=1):
+    out = sys.stdout
+    for result in differentiate_many(source, workers=jobs, return_exceptions=True):
+        if isinstance(result, Exception):
+            result = f'error: {result}'
+        out.write(result + '\n')
+
+def main(argv):
+    if '--batch' in argv:
+        import argparse
+        parser = argparse.ArgumentParser(prog='quickderiv')
+        parser.add_argument('--batch', action='store_true',
+                            help='differentiate one expression per line')
+        parser.add_argument('--jobs', type=int, default=1,
+                            help='worker processes (default: 1)')
+        parser.add_argument('file', nargs='?', default='-',
+                            help="input file, or '-' for stdin")
+        args = parser.parse_args(argv)
+        if args.file == '-':
+            batch(sys.stdin, args.jobs)
+        else:
+            with open(args.file) as source:
+                batch(source, args.jobs)
+    elif argv:
+        try:
+            print(derive(''.join(argv)))
+        except (ValueError, ArithmeticError, RecursionError) as e:
+            # Same report as a bad line in batch mode, with a failing exit status
+            sys.exit(f'error: {e}')
+    else:
+        # Only the game needs pygame, keep it off the differentiation path
+        import game
+        game.install_dependencies()
+        import pygame
+        game.play()
+        #game.play((1920, 1080), pygame.FULLSCREEN | pygame.DOUBLEBUF | pygame.HWSURFACE)
+
+if __name__ == '__main__':
+    # Batch workers re-enter this script in a frozen build, let them take
+    # over there; plain runs skip importing multiprocessing
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
+    main(sys.argv[1:])
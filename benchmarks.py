@@ -0,0 +1,450 @@
+import argparse, json, os, platform, random, subprocess, sys, time, timeit, tracemalloc
+from datetime import datetime, timedelta
+from expressions import Expression, Term, differentiate_many, dumps_many, loads_many, tokenize
+
+def best_time(func, repeat=5, number=1):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+def random_polynomial(size, degree=None, variables='x', seed=0):
+    rng = random.Random(seed)
+    if degree is None:
+        degree = max(size // 4, 1)
+    terms = list()
+    for i in range(size):
+        variable = rng.choice(variables)
+        exponent = rng.randint(0, degree)
+        powers = ((variable, exponent),) if exponent else ()
+        terms.append(Term(rng.randint(-20, 20) or 1, powers))
+    return terms
+
+def bench_collect_terms(sizes=(10, 100, 1000, 10000)):
+    print('collect_terms')
+    for size in sizes:
+        terms = random_polynomial(size)
+        def run():
+            Expression(terms=terms).collect_terms()
+        seconds = best_time(run)
+        print(f'  {size:>6} terms: {seconds * 1e3:9.3f} ms '
+              f'({seconds / size * 1e6:.3f} us/term)')
+
+def bench_parse(sizes=(10, 100, 1000, 10000)):
+    print('parse')
+    for size in sizes:
+        text = str(Expression(terms=random_polynomial(size)))
+        tokens = len(tokenize(text))
+        lex_seconds = best_time(lambda: tokenize(text))
+        parse_seconds = best_time(lambda: Expression(parse=text))
+        print(f'  {size:>6} terms: lex {tokens / lex_seconds:12,.0f} tokens/s, '
+              f'parse {tokens / parse_seconds:12,.0f} tokens/s')
+
+def nested_expression(depth):
+    text = 'x'
+    for i in range(depth):
+        text = f'({text} ^ 2 + {i % 3 + 1}x)'
+    return text
+
+def count_terms(expression, seen=None):
+    # Distinct sub-expressions are shared, so each is only counted once
+    if seen is None:
+        seen = set()
+    total = len(expression.terms)
+    for term in expression.terms:
+        for atom, exponent in term.powers:
+            if not isinstance(atom, str) and id(atom) not in seen:
+                seen.add(id(atom))
+                total += count_terms(atom, seen)
+    return total
+
+def bench_nesting(depths=(10, 20, 40, 80, 100)):
+    print('nesting')
+    for depth in depths:
+        y = Expression(parse=nested_expression(depth))
+        def run():
+            dy = y.differentiate()
+            dy.collect_terms()
+            return dy
+        seconds = best_time(run)
+        print(f'  depth {depth:>4}: {seconds * 1e3:9.3f} ms, '
+              f'{count_terms(y):>5} terms in, {count_terms(run()):>5} terms out')
+
+def question_mix(count, seed=0):
+    # The game's own question generator, seeded so runs are comparable
+    import game
+    random.seed(seed)
+    make_part = game.PlayingState._make_question_part
+    return [' + '.join(make_part() for i in range(3)) for j in range(count)]
+
+def bench_workers(workers=(1, 2, 4, 8), count=100000):
+    print(f'differentiate_many ({os.cpu_count()} cpus)')
+    texts = question_mix(count)
+    base = None
+    for n in workers:
+        seconds = best_time(lambda: sum(1 for r in differentiate_many(texts, workers=n)),
+                            repeat=1)
+        base = base or seconds
+        print(f'  {n:>2} workers: {count / seconds:10,.0f} expressions/s '
+              f'(x{base / seconds:.2f})')
+
+def bench_serialize(count=100000):
+    print('serialize')
+    texts = question_mix(count)
+    ys = [Expression(parse=text) for text in texts]
+    data = dumps_many(ys)
+    parse_seconds = best_time(lambda: [Expression(parse=text) for text in texts], repeat=3)
+    dump_seconds = best_time(lambda: dumps_many(ys), repeat=3)
+    load_seconds = best_time(lambda: loads_many(data), repeat=3)
+    print(f'  {count} expressions, {len(data) / count:.1f} bytes each')
+    print(f'  parse: {count / parse_seconds:10,.0f} expressions/s')
+    print(f'  dump:  {count / dump_seconds:10,.0f} expressions/s')
+    print(f'  load:  {count / load_seconds:10,.0f} expressions/s '
+          f'(x{parse_seconds / load_seconds:.1f} vs parse)')
+
+def bench_startup(expression='3x^2 + 2x + 5', runs=5):
+    print('startup')
+    main = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__main__.py')
+    walls = list()
+    for i in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', main, expression],
+                                 capture_output=True, text=True, check=True)
+        walls.append(time.perf_counter() - start)
+    # Lines look like 'import time: self [us] | cumulative | package', with
+    # nested imports indented under the package that pulled them in
+    imports = list()
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative_us, package = line[len('import time:'):].split('|')
+            if cumulative_us.strip().isdigit() and not package[1:].startswith(' '):
+                imports.append((int(cumulative_us), package.strip()))
+    imports.sort(reverse=True)
+    print(f'  wall: {min(walls) * 1e3:.1f} ms, '
+          f'imports: {sum(us for us, package in imports) / 1e3:.1f} ms')
+    for us, package in imports[:5]:
+        print(f'    {package:<28} {us / 1e3:8.1f} ms')
+    for package in ('pygame', 'numpy', 'game', 'multiprocessing'):
+        if any(name == package for us, name in imports):
+            print(f'  warning: {package} imported on the CLI path')
+
+def bench_memory(sizes=(100, 1000, 10000, 100000)):
+    print('memory (differentiate + collect_terms)')
+    for size in sizes:
+        y = Expression(terms=random_polynomial(size, variables='xy'))
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        dy = y.differentiate('x')
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        # Blocks still held afterwards are the result itself, the rest of the
+        # peak is intermediate copies
+        retained = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+        print(f'  {size:>6} terms: {peak / 1024:10.1f} KiB peak, '
+              f'{retained / 1024:10.1f} KiB result, x{peak / max(retained, 1):.2f}')
+
+def bench_frame(resolution=(1080, 720), frames=300, log=None):
+    print(f'frame {resolution[0]}x{resolution[1]}')
+    # Headless, so it runs without a display or sound card
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    import game, pygame, ptext
+    pygame.init()
+    pygame.mixer.init()
+    screen = pygame.display.set_mode(resolution)
+    state = game.PlayingState(None, resolution, game.Audio())
+    # Straight into play, past the opening fade
+    state.opening = False
+    state.fade.reset(showing=True)
+    state.next_time = state._make_next_time(3600)
+    profiler = game.frame_profiler
+    # Count calls into pygame.draw and ptext, blits are Surface methods and
+    # cannot be wrapped
+    calls = dict()
+    def counted(module, name):
+        function = getattr(module, name)
+        def wrapper(*args, **kwargs):
+            calls[name] = calls.get(name, 0) + 1
+            return function(*args, **kwargs)
+        setattr(module, name, wrapper)
+        return function
+    area = resolution[0] * resolution[1]
+    def run_frames(count):
+        # The same steps as the game loop, minus waiting for the next tick
+        pushed = surfaces = 0
+        sections = dict.fromkeys(game.FRAME_SECTIONS, 0.0)
+        for i in range(count):
+            profiler.begin_frame()
+            profiler.mark('events')
+            state.update([], screen, *resolution)
+            profiler.mark('update')
+            # Overlapping rects count twice
+            if state.dirty_rects is None:
+                pygame.display.update()
+                pushed += area
+            else:
+                pygame.display.update(state.dirty_rects)
+                pushed += sum(r.clip(screen.get_rect()).width * r.clip(screen.get_rect()).height
+                              for r in state.dirty_rects)
+            profiler.mark('display')
+            profiler.end_frame()
+            for section, seconds in profiler.sections.items():
+                sections[section] += seconds
+            surfaces += profiler.surfaces
+        return pushed, sections, surfaces
+    originals = [(pygame.draw, name, counted(pygame.draw, name))
+                 for name in ('line', 'lines', 'rect', 'circle', 'polygon')]
+    originals.append((ptext, 'draw', counted(ptext, 'draw')))
+    try:
+        profiler.start(log)
+        # A burst right after a correct answer, then the idle frames while
+        # the player types
+        for phase, since in (('burst', 0), ('idle', 10)):
+            state.last_correct = datetime.now() - timedelta(seconds=since)
+            state.update([], screen, *resolution)
+            calls.clear()
+            profiler.totals.clear()
+            start = time.perf_counter()
+            pushed, sections, surfaces = run_frames(frames)
+            seconds = (time.perf_counter() - start) / frames
+            percentiles = profiler.percentiles()
+            draw_calls = sum(calls.values())
+            # Counting surfaces slows frames down, so it gets a pass of its own
+            profiler.count_surfaces = True
+            surfaces = run_frames(frames // 10)[2] / (frames // 10)
+            profiler.count_surfaces = False
+            print(f'  {phase:<6} {seconds * 1e3:.3f} ms/frame '
+                  f'(p50 {percentiles[50] * 1e3:.3f}, p95 {percentiles[95] * 1e3:.3f}, '
+                  f'p99 {percentiles[99] * 1e3:.3f}), '
+                  f'{draw_calls / frames:.1f} draw calls/frame, {surfaces:.1f} surfaces/frame, '
+                  f'{pushed / frames / area:.1%} of the screen pushed')
+            for section, total in sorted(sections.items(), key=lambda item: item[1], reverse=True):
+                if total:
+                    print(f'    {section:<12} {total / frames * 1e3:8.3f} ms')
+    finally:
+        for module, name, function in originals:
+            setattr(module, name, function)
+        profiler.stop()
+        pygame.quit()
+
+# Times are seconds of game time from the start. Entries press a key or type
+# text, where $answer types the derivative of the question on screen
+REPLAY_SCRIPT = [
+
+    {'time': 1.0, 'key': 'return'},
+    {'time': 3.0, 'text': '$answer'},
+    {'time': 3.2, 'key': 'return'},
+    {'time': 6.0, 'text': '$answer'},
+    {'time': 6.2, 'key': 'return'},
+    {'time': 7.0, 'text': 'x ^ 2 +'},
+    {'time': 7.3, 'key': 'backspace'},
+    {'time': 7.5, 'key': 'return'},
+    {'time': 9.0, 'text': '$answer'},
+    {'time': 9.2, 'key': 'return'},
+    # The timer runs out at about 28 seconds
+    {'time': 30.0, 'key': 'right'},
+    {'time': 30.5, 'key': 'left'},
+    {'time': 31.0, 'key': 'return'},
+    {'time': 33.0, 'key': 'down'},
+    {'time': 33.2, 'key': 'return'},
+    {'time': 33.5, 'key': 'up'},
+    {'time': 34.0, 'key': 'return'},
+    {'time': 36.0, 'text': '$answer'},
+    {'time': 36.5, 'key': 'escape'},
+    {'time': 38.0}
+
+]
+
+def replay_events(entry, state, pygame):
+    # Each key goes down and up within the frame, so TextInput never repeats it
+    if 'key' in entry:
+        key = pygame.key.key_code(entry['key'])
+        presses = [(key, '\r' if key == pygame.K_RETURN else '')]
+    else:
+        text = entry.get('text', '')
+        if text == '$answer':
+            text = str(state.questions[-1].y_prime) if getattr(state, 'questions', None) else ''
+        presses = [(pygame.K_UNKNOWN, char) for char in text]
+    events = list()
+    for key, unicode in presses:
+        events.append(pygame.event.Event(pygame.KEYDOWN, key=key, unicode=unicode))
+        events.append(pygame.event.Event(pygame.KEYUP, key=key))
+    return events
+
+def bench_replay(script=None, seed=0, resolution=(1080, 720), fps=60):
+    print(f'replay {resolution[0]}x{resolution[1]}, seed {seed}')
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    import game, pygame
+    if script is None:
+        script = REPLAY_SCRIPT
+    elif isinstance(script, str):
+        with open(script) as f:
+            script = json.load(f)
+    script = sorted(script, key=lambda entry: entry['time'])
+    # Game time only moves on by one frame per update, so timers, star
+    # bursts and questions come out the same on every run
+    start = datetime(2000, 1, 1)
+    class ReplayClock(datetime):
+        current = start
+        @classmethod
+        def now(cls, tz=None):
+            return cls.current
+    saved = game.datetime, game.QUESTION_BANK_DEPTH
+    game.datetime = ReplayClock
+    # Questions are made on the spot rather than racing a background thread
+    game.QUESTION_BANK_DEPTH = 0
+    random.seed(seed)
+    pygame.init()
+    pygame.mixer.init()
+    try:
+        # The display only exists so images can be converted, frames are
+        # drawn off screen
+        pygame.display.set_mode(resolution)
+        screen = pygame.Surface(resolution)
+        state = game.MenuState(resolution, game.Audio())
+        times = dict()
+        visited = [str(state)]
+        scores = list()
+        entries = iter(script)
+        entry = next(entries, None)
+        frame = 0
+        while state is not None and entry is not None:
+            ReplayClock.current = start + timedelta(seconds=frame / fps)
+            events = list()
+            while entry is not None and entry['time'] * fps <= frame:
+                events.extend(replay_events(entry, state, pygame))
+                entry = next(entries, None)
+            label = str(state)
+            began = time.perf_counter()
+            update, updated, rects = game.step(state, events, screen, *resolution)
+            times.setdefault(label, list()).append(time.perf_counter() - began)
+            if update is not state and update is not None:
+                visited.append(str(update))
+                if isinstance(update, game.GameOverState):
+                    scores.append(update.score)
+            state = update
+            frame += 1
+    finally:
+        game.datetime, game.QUESTION_BANK_DEPTH = saved
+        pygame.quit()
+    totals = sorted(t for label_times in times.values() for t in label_times)
+    def percentile(values, p):
+        return values[min(len(values) * p // 100, len(values) - 1)]
+    print(f'  {len(totals)} frames, {len(totals) / sum(totals):,.0f} frames/s, '
+          f'p50 {percentile(totals, 50) * 1e3:.3f} ms, p95 {percentile(totals, 95) * 1e3:.3f} ms, '
+          f'p99 {percentile(totals, 99) * 1e3:.3f} ms, max {totals[-1] * 1e3:.3f} ms')
+    for label, label_times in times.items():
+        label_times.sort()
+        print(f'    {label:<10} {len(label_times):>6} frames, '
+              f'{len(label_times) / sum(label_times):10,.0f} frames/s, '
+              f'p95 {percentile(label_times, 95) * 1e3:.3f} ms')
+    # Checked between runs, the same seed and script always take this path
+    print(f'  states: {" -> ".join(visited)}, scores: {scores}')
+    return {'frames': len(totals), 'visited': visited, 'scores': scores}
+
+SUITE_OPERATIONS = {
+
+    'parse': lambda text, y: Expression(parse=text),
+    'differentiate': lambda text, y: y.differentiate(),
+    'collect_terms': lambda text, y: Expression(terms=y.terms).collect_terms(),
+    'evaluate': lambda text, y: y.evaluate(x=0.1),
+    'eq': lambda text, y: Expression(terms=y.terms) == Expression(terms=y.terms)
+
+}
+
+def suite_workloads():
+    workloads = dict()
+    for name, size in (('tiny', 5), ('small', 50), ('medium', 500), ('large', 10000)):
+        workloads[f'polynomial-{name}'] = [str(Expression(terms=random_polynomial(size)))]
+    for depth in (20, 80):
+        workloads[f'nested-{depth}'] = [nested_expression(depth)]
+    workloads['questions'] = question_mix(1000)
+    return workloads
+
+def measure(operation, items, target=0.2):
+    def run():
+        for text, y in items:
+            operation(text, y)
+    # Scale the loop count so each sample takes roughly the target time
+    number = max(1, int(target / max(best_time(run, repeat=1), 1e-6)))
+    seconds = best_time(run, repeat=3, number=number)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    results = [operation(text, y) for text, y in items]
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # Blocks still held once the operation returns, results included
+    retained = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    del results
+    return {'ops_per_sec': len(items) / seconds,
+            'peak_bytes_per_op': peak / len(items),
+            'retained_blocks_per_op': retained / len(items)}
+
+def bench_suite(output=None, compare=None):
+    print('suite')
+    records = list()
+    for workload, texts in suite_workloads().items():
+        items = [(text, Expression(parse=text)) for text in texts]
+        for operation, function in SUITE_OPERATIONS.items():
+            record = {'workload': workload, 'operation': operation}
+            record.update(measure(function, items))
+            records.append(record)
+            print(f'  {workload:<18} {operation:<14} {record["ops_per_sec"]:14,.1f} ops/s '
+                  f'{record["peak_bytes_per_op"] / 1024:10.1f} KiB peak '
+                  f'{record["retained_blocks_per_op"]:9.1f} blocks')
+    results = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'records': records}
+    if compare is not None:
+        with open(compare) as f:
+            baseline = {(r['workload'], r['operation']): r for r in json.load(f)['records']}
+        print(f'  compared with {compare}:')
+        for record in records:
+            old = baseline.get((record['workload'], record['operation']))
+            if old is not None:
+                print(f'  {record["workload"]:<18} {record["operation"]:<14} '
+                      f'x{record["ops_per_sec"] / old["ops_per_sec"]:6.2f} speed '
+                      f'x{record["peak_bytes_per_op"] / max(old["peak_bytes_per_op"], 1):6.2f} peak')
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+BENCHMARKS = {
+
+    'collect_terms': bench_collect_terms,
+    'frame': bench_frame,
+    'memory': bench_memory,
+    'nesting': bench_nesting,
+    'serialize': bench_serialize,
+    'parse': bench_parse,
+    'replay': bench_replay,
+    'startup': bench_startup,
+    'suite': bench_suite,
+    'workers': bench_workers
+
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='quickderiv benchmarks')
+    parser.add_argument('names', nargs='*', choices=[[]] + list(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--json', metavar='PATH', help='save suite results as JSON')
+    parser.add_argument('--compare', metavar='PATH', help='compare suite results with a saved run')
+    parser.add_argument('--script', metavar='PATH', help='JSON event script for replay')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for replay')
+    parser.add_argument('--frame-log', metavar='PATH',
+                        help='log frame timings as CSV (.csv) or JSON lines')
+    args = parser.parse_args()
+    for name in args.names or BENCHMARKS:
+        if name == 'suite':
+            bench_suite(args.json, args.compare)
+        elif name == 'frame':
+            bench_frame(log=args.frame_log)
+        elif name == 'replay':
+            bench_replay(args.script, args.seed)
+        else:
+            BENCHMARKS[name]()
@@ -1,25 +1,52 @@
-import math, random
+import bisect, functools, itertools, math, random, re, struct, sys, time
+from array import array
+from collections import namedtuple
+from fractions import Fraction
 
 OPERATORS = {
-  
+
   '+': lambda x, y: x + y,
   '-': lambda x, y: x - y,
   '/': lambda x, y: x / y,
   '*': lambda x, y: x * y,
   '^': math.pow
-  
-}
-SPLIT_OPERATORS = (
-
-    OPERATORS['+'],
-    OPERATORS['-']
-
-)
 
-def removeall(seq, sub):
-    for item in sub:
-        if item in seq:
-            seq.remove(item)
+}
+# Process-wide LRU caches, empty until enable_cache() is called
+CACHES = dict()
+# Per-stage counters, empty until enable_profiling() is called
+PROFILE = dict()
+# Original functions of the profiled stages while profiling is enabled
+UNPROFILED = dict()
+PROFILED_STAGES = ('_parse_terms', '_distribute', '_like_terms', '_remove_zeroes',
+                   '_remove_constants', '_power_rule')
+# Filled with numpy ufuncs the first time an array is evaluated
+ARRAY_OPERATORS = dict()
+OPERATOR_NAMES = {'+': '_add', '-': '_sub', '/': '_div', '*': '_mul', '^': '_pow'}
+NUMBER = 'number'
+VARIABLE = 'variable'
+OPERATOR = 'operator'
+PAREN = 'paren'
+TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+      (?P<number>\d+\.?\d*|\.\d+)
+    | (?P<variable>[^\W\d_])
+    | (?P<operator>[-+*/^])
+    | (?P<paren>[()])
+    | (?P<error>\S)
+    )''', re.VERBOSE)
+Token = namedtuple('Token', 'kind value')
+# Binary format opcodes, see dumps_many()
+OP_INT, OP_FLOAT, OP_BIGINT, OP_VARIABLE, OP_GROUP, OP_GROUP_REF, OP_RATIONAL = range(7)
+FORMAT_MAGIC = b'QD'
+FORMAT_VERSION = 2
+FORMAT_HEADER = struct.Struct('<2sBIIII')
+# Parsing recurses a few frames per parenthesis, so deeper input is rejected
+# before it can reach the recursion limit
+MAX_NESTING = 100
+# Exact powers with results larger than this many bits are left to math.pow,
+# so a long exponent typed into the game fails fast instead of stalling it
+MAX_EXACT_BITS = 1 << 13
 
 def count(seq, pred):
     return sum(1 for v in seq if pred(v))
@@ -27,258 +54,968 @@ def count(seq, pred):
 def randombool():
     return bool(random.getrandbits(1))
 
-def tryint(val):
-    try:
-        return int(val)
-    except:
-        return val
-
-def splitlist(data, *separators):
-    result = [list()]
-    for i in data:
-        if i in separators:
-            result.append(list())
+def array_module(values):
+    # Arrays can only come from an already imported numpy, so the scalar path
+    # never pays for importing it
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and any(isinstance(v, numpy.ndarray) for v in values):
+        if not ARRAY_OPERATORS:
+            ARRAY_OPERATORS.update({
+
+              '+': numpy.add,
+              '-': numpy.subtract,
+              '/': numpy.true_divide,
+              '*': numpy.multiply,
+              '^': numpy.float_power
+
+            })
+        return numpy
+    return None
+
+def tokenize(parse):
+    tokens = list()
+    for match in TOKEN_PATTERN.finditer(parse):
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == NUMBER:
+            # Decimals are read exactly, 0.1 is 1/10
+            value = Fraction(text) if '.' in text else int(text)
+            tokens.append(Token(NUMBER, value))
+        elif kind == VARIABLE or text == '(':
+            # Implicit multiplication, as in 2x, xy or 2(x + 1)
+            if tokens and (tokens[-1].kind in (NUMBER, VARIABLE) or tokens[-1].value == ')'):
+                tokens.append(Token(OPERATOR, '*'))
+            tokens.append(Token(kind, text))
+        elif kind in (OPERATOR, PAREN):
+            tokens.append(Token(kind, text))
         else:
-            result[-1].append(i)
-    return result
-
-def joinlist(data, separator):
-    result = list()
-    for i in data:
-        if i:
-            result.extend(i)
-            result.append(separator)
-    if len(result) > 0:
-        del result[-1]
-    return result
+            raise ValueError(f'Unexpected character: {text}')
+    return tokens
 
-class Expression:
-    def __init__(self, parse=None, data=None):
-        if data is None:
-            data = list()
-        self.data = data
-        if parse is not None:
-            buf = str()
-            invert = False
-            if len(parse) > 0 and parse[0] == '-':
-                parse = parse[1:]
-                invert = True
-            for c in parse:
-                if c in OPERATORS:
-                    cop = OPERATORS[c]
-                    self._append(buf)
-                    invert = cop == OPERATORS['-']
-                    self.data.append(cop)
-                    buf = str()
-                elif not c.isspace():
-                    if c.isalpha():
-                        self._append(buf, invert)
-                        if len(self.data) > 0 and self.data[-1] not in OPERATORS.values():
-                            self.data.append(OPERATORS['*'])
-                        self.data.append(c)
-                        buf = str()
-                    else:
-                        buf += c
-            self._append(buf)
+def check_nesting(tokens):
+    depth = 0
+    for token in tokens:
+        if token.kind == PAREN:
+            depth += 1 if token.value == '(' else -1
+            if depth > MAX_NESTING:
+                raise ValueError(f'Too many nested parentheses, the limit is {MAX_NESTING}')
 
-    def collect_terms(self):
-        self.data = self._like_terms(self.data)
-        self.data = self._remove_zeroes(self.data)
+def normalize(value):
+    # Whole rationals go back to plain ints so the common case stays fast
+    if type(value) is Fraction and value.denominator == 1:
+        return value.numerator
+    return value
+
+def is_exact(value):
+    return isinstance(value, (int, Fraction))
+
+def divide(x, y):
+    if type(x) is int and type(y) is int:
+        return x // y if x % y == 0 else Fraction(x, y)
+    if is_exact(x) and is_exact(y):
+        return normalize(Fraction(x) / y)
+    return OPERATORS['/'](x, y)
+
+def integer_root(value, n):
+    # Newton's method on ints, starting above the root
+    if value < 2:
+        return value
+    root = 1 << -(-value.bit_length() // n)
+    while True:
+        better = ((n - 1) * root + value // root ** (n - 1)) // n
+        if better >= root:
+            break
+        root = better
+    return root if root ** n == value else None
+
+def bit_size(value):
+    if type(value) is Fraction:
+        return max(value.numerator.bit_length(), value.denominator.bit_length())
+    return value.bit_length()
 
-    def _append(self, buf, invert=False):
-        if buf:
-            i = tryint(buf.strip())
-            if invert and (isinstance(i, int) or isinstance(i, float)):
-                i *= -1
-            self.data.append(i)
+def power(x, y):
+    y = normalize(y)
+    # Less one bit, so powers of 0, 1 and -1 are always exact
+    if type(y) is int and is_exact(x) and abs(y) * (bit_size(x) - 1) <= MAX_EXACT_BITS:
+        return x ** y if y >= 0 else normalize(Fraction(x) ** y)
+    if x == 1:
+        return x
+    if type(y) is Fraction and is_exact(x) and x > 0:
+        # Perfect powers such as 4 ^ (1/2) stay exact
+        x = Fraction(x)
+        numerator = integer_root(x.numerator, y.denominator)
+        denominator = integer_root(x.denominator, y.denominator)
+        if numerator is not None and denominator is not None:
+            return power(normalize(Fraction(numerator, denominator)), y.numerator)
+    # Irrational results are the one place coefficients turn into floats
+    return OPERATORS['^'](x, y)
 
-    def tokenize_terms(self, exp=None):
-        return splitlist(self.data if exp is None else exp, *SPLIT_OPERATORS)
+def atom_key(atom):
+    # Atoms are variable names or parenthesised sub-expressions, which only
+    # compare among themselves. Groups go by their canonical form, so (x + 1)
+    # and (1 + x) sort the same
+    return (0, atom) if isinstance(atom, str) else (1, atom.get_sort_key())
+
+def powers_key(powers):
+    return [(atom_key(atom), exponent) for atom, exponent in powers]
+
+def term_key(term):
+    return powers_key(term.powers)
+
+class Term:
+    __slots__ = ('coefficient', 'powers')
+
+    def __init__(self, coefficient=1, powers=()):
+        self.coefficient = coefficient
+        # Sorted (atom, exponent) pairs with no zero exponents, so the tuple
+        # doubles as a hashable key for like terms
+        self.powers = powers
+
+    @classmethod
+    def variable(cls, name):
+        return cls(1, ((name, 1),))
+
+    @classmethod
+    def group(cls, expression):
+        # A sum that cannot be folded into a single term becomes an atom
+        if not expression.terms:
+            return cls(0)
+        if len(expression.terms) == 1:
+            return expression.terms[0]
+        return cls(1, ((expression, 1),))
 
     @staticmethod
-    def _evaluate(exp, *test):
-        i = 0
-        while i < len(exp):
-            if i != 0 and exp[i] in test:
-                one = exp[i - 1]
-                two = exp[i + 1]
-                if not isinstance(one, str) and not isinstance(two, str):
-                    exp[i - 1] = exp[i](one, two)
-                    del exp[i]
-                    del exp[i]
-                else:
-                    return False
-                    i += 1
+    def _merge_powers(powers, other, sign=1):
+        merged = dict(powers)
+        for atom, exponent in other:
+            merged[atom] = normalize(merged.get(atom, 0) + sign * exponent)
+        return tuple(sorted(((a, e) for a, e in merged.items() if e != 0),
+                            key=lambda item: atom_key(item[0])))
+
+    def multiply(self, other):
+        return Term(normalize(self.coefficient * other.coefficient),
+                    self._merge_powers(self.powers, other.powers))
+
+    def divide(self, other):
+        return Term(divide(self.coefficient, other.coefficient),
+                    self._merge_powers(self.powers, other.powers, -1))
+
+    def raise_to(self, exponent):
+        if exponent == 0:
+            return Term(1)
+        return Term(power(self.coefficient, exponent),
+                    tuple((v, normalize(e * exponent)) for v, e in self.powers))
+
+    def negate(self):
+        return Term(-self.coefficient, self.powers)
+
+    def get_order(self):
+        return sum(e for v, e in self.powers)
+
+    def get_exponent(self, variable):
+        for v, e in self.powers:
+            if v == variable:
+                return e
+        return 0
+
+    def depends_on(self, variable):
+        return any(atom == variable if isinstance(atom, str)
+                   else variable in atom.get_variables()
+                   for atom, exponent in self.powers)
+
+    def derivative(self, variable, atom_derivative):
+        # Product rule across the factors, with the power rule on each one and
+        # the chain rule through parenthesised atoms; negative exponents cover
+        # quotients
+        terms = list()
+        for i, (atom, exponent) in enumerate(self.powers):
+            if isinstance(atom, str):
+                if atom != variable:
+                    continue
+                inner = Term(1)
+            else:
+                inner = Term.group(atom_derivative(atom))
+                if inner.coefficient == 0:
+                    continue
+            powers = self.powers[:i] + ((atom, exponent - 1),) + self.powers[i + 1:]\
+                     if exponent != 1 else self.powers[:i] + self.powers[i + 1:]
+            terms.append(Term(normalize(self.coefficient * exponent), powers).multiply(inner))
+        return terms
+
+    def substitute(self, values):
+        coefficient = self.coefficient
+        powers = list()
+        for atom, exponent in self.powers:
+            if isinstance(atom, str):
+                if atom not in values:
+                    powers.append((atom, exponent))
+                    continue
+                value = values[atom]
             else:
+                value = atom.evaluate(**values)
+                if isinstance(value, Expression):
+                    powers.append((value, exponent))
+                    continue
+            coefficient *= value if exponent == 1 else power(value, exponent)
+        return Term(coefficient, tuple(powers))
+
+    @staticmethod
+    def _factor_str(atom, exponent):
+        base = atom if isinstance(atom, str) else f'({atom})'
+        if exponent == 1:
+            return base
+        return f'{base} ^ ({exponent})' if type(exponent) is Fraction else f'{base} ^ {exponent}'
+
+    def __str__(self):
+        factors = [self._factor_str(a, e) for a, e in self.powers]
+        if not factors or self.coefficient not in (1, -1):
+            factors.insert(0, str(self.coefficient))
+        elif self.coefficient == -1:
+            factors[0] = '-' + factors[0]
+        return ' * '.join(factors)
+
+class Expression:
+    def __init__(self, parse=None, terms=None):
+        if terms is None:
+            terms = list()
+        self.terms = terms
+        if parse is not None:
+            self.terms = self._parse_terms(tokenize(parse))
+
+    @property
+    def terms(self):
+        return self._terms
+
+    @terms.setter
+    def terms(self, terms):
+        # Reassigning the terms drops the cached canonical form, hash, string
+        # and compiled evaluators; the list itself is not expected to be mutated in place
+        self._terms = terms
+        self._canonical = None
+        self._sort_key = None
+        self._hash = None
+        self._str = None
+        self._compiled = dict()
+
+    @staticmethod
+    def _operator_at(tokens, i):
+        if i < len(tokens) and tokens[i].kind == OPERATOR:
+            return tokens[i].value
+        return None
+
+    @classmethod
+    def _parse_terms(cls, tokens):
+        check_nesting(tokens)
+        terms, i = cls._parse_sum(tokens, 0)
+        if i < len(tokens):
+            raise ValueError(f'Unexpected token: {tokens[i].value}')
+        return terms
+
+    @classmethod
+    def _parse_sum(cls, tokens, i):
+        terms = list()
+        sign = 1
+        while i < len(tokens) and tokens[i].value != ')':
+            term, i = cls._parse_product(tokens, i)
+            terms.append(term if sign > 0 else term.negate())
+            if i < len(tokens) and tokens[i].value != ')':
+                symbol = cls._operator_at(tokens, i)
+                if symbol not in ('+', '-'):
+                    raise ValueError(f'Unexpected token: {tokens[i].value}')
+                sign = 1 if symbol == '+' else -1
                 i += 1
-        return True
+                if i == len(tokens) or tokens[i].value == ')':
+                    raise ValueError('Expression ends with an operator')
+        return terms, i
 
     @classmethod
-    def _evaluate_list(cls, exp, **kwargs):
-        for i in range(len(exp)):
-            if exp[i] in kwargs:
-                exp[i] = kwargs[exp[i]]
-        cls._evaluate(exp, OPERATORS['^'])
-        cls._evaluate(exp, OPERATORS['*'], OPERATORS['/'])
-        cls._evaluate(exp, OPERATORS['+'], OPERATORS['-'])
+    def _parse_product(cls, tokens, i):
+        term, i = cls._parse_factor(tokens, i)
+        symbol = cls._operator_at(tokens, i)
+        while symbol in ('*', '/'):
+            other, i = cls._parse_factor(tokens, i + 1)
+            term = term.multiply(other) if symbol == '*' else term.divide(other)
+            symbol = cls._operator_at(tokens, i)
+        return term, i
 
-    def evaluate(self, **kwargs):
-        exp = self.data[:]
-        self._evaluate_list(exp, **kwargs)
-        return exp[0] if len(exp) == 1 else exp
+    @classmethod
+    def _parse_factor(cls, tokens, i):
+        negate = cls._operator_at(tokens, i) == '-'
+        if negate:
+            i += 1
+        term, i = cls._parse_atom(tokens, i)
+        while cls._operator_at(tokens, i) == '^':
+            sign = -1 if cls._operator_at(tokens, i + 1) == '-' else 1
+            exponent, i = cls._parse_atom(tokens, i + (1 if sign > 0 else 2))
+            if exponent.powers:
+                raise ValueError('Variable exponents are not supported')
+            term = term.raise_to(sign * exponent.coefficient)
+        return (term.negate() if negate else term), i
 
-    @staticmethod
-    def get_order(exp):
-        if OPERATORS['^'] in exp:
-            return exp[exp.index(OPERATORS['^']) + 1]
+    @classmethod
+    def _parse_atom(cls, tokens, i):
+        if i >= len(tokens):
+            raise ValueError('Expression ends with an operator')
+        token = tokens[i]
+        if token.kind == OPERATOR:
+            raise ValueError(f'Unexpected operator: {token.value}')
+        if token.kind == VARIABLE:
+            return Term.variable(token.value), i + 1
+        if token.kind == PAREN:
+            if token.value == ')':
+                raise ValueError('Unmatched )')
+            terms, i = cls._parse_sum(tokens, i + 1)
+            if i >= len(tokens):
+                raise ValueError('Unmatched (')
+            if not terms:
+                raise ValueError('Empty parentheses')
+            group = cls(terms=terms)
+            group.collect_terms()
+            return Term.group(group), i + 1
+        return Term(token.value), i + 1
+
+    def collect_terms(self):
+        cache = CACHES.get('collect_terms')
+        if cache is not None:
+            self.terms = list(cache(self.get_key()))
         else:
-            return len(list(filter(lambda x: isinstance(x, str), exp)))
+            self.terms = self._collected_terms()
+
+    def _collected_terms(self, terms=None):
+        # The stages pass terms along as a stream, only like terms are
+        # gathered in a dict and the result is the one list built. It comes
+        # out in canonical order, so it reads the same whichever order the
+        # terms arrived in and whether or not it came from the cache
+        if terms is None:
+            terms = self.terms
+        terms = self._distribute(terms)
+        terms = self._like_terms(terms)
+        return sorted(self._remove_zeroes(terms), key=term_key, reverse=True)
+
+    def get_key(self):
+        # Built from the canonical form so any ordering of the same sum shares
+        # a cache entry, with numbers tagged by type so 2 and 2.0 don't
+        return tuple((tuple((atom if isinstance(atom, str) else atom.get_key(), (type(exponent), exponent))
+                            for atom, exponent in powers), (type(coefficient), coefficient))
+                     for powers, coefficient in self.get_canonical())
 
     @classmethod
-    def get_coefficient(cls, exp, duplicate=True):
-        if len(exp) == 1:
-            return (1, exp[0]) if isinstance(exp[0], str) else exp[0]
-        if duplicate:
-            exp = exp[:]
-        c = 0
-        if OPERATORS['*'] in exp:
-            mul_index = exp.index(OPERATORS['*'])
-            if mul_index + 1 > len(exp) and isinstance(exp[mul_index + 1], int):
-                c = exp[mul_index + 1]
-                del exp[mul_index]
-                del exp[mul_index]
-            if mul_index - 1 <= 0 and isinstance(exp[mul_index - 1], int):
-                c = exp[mul_index - 1]
-                del exp[mul_index - 1]
-                del exp[mul_index - 1]
-        if c == 0:
-            return 0
-        recurse = cls.get_coefficient(exp, duplicate=False)
-        return (c + recurse if isinstance(recurse, int) else c, exp)
-
-    def _like_terms(self, exp):
-        split = self.tokenize_terms(exp)
-        if len(split) <= 0:
-            return list()
-        if len(split) == 1:
-            return exp[:]
-        result = list()
-        i = 0
-        while i < len(split):
-            item = split[i]
-            item_order = self.get_order(item)
-            if item_order == 0:
-                co = self.get_coefficient(item)
-            else:
-                co, ex = self.get_coefficient(item)
-            matchings = list(filter(lambda x: x is not item and self.get_order(x) == item_order, split))
-            for matching in matchings:
-                matching_co = self.get_coefficient(matching)
-                co += matching_co if isinstance(matching_co, int) else matching_co[0]
-            if item_order > 0:
-                if co > 1:
-                    append = [co, OPERATORS['*']]
-                    append.extend(ex)
-                    result.append(append)
+    def from_key(cls, key):
+        terms = list()
+        for powers, (_, coefficient) in key:
+            powers = tuple((atom if isinstance(atom, str) else cls.from_key(atom), exponent)
+                           for atom, (_, exponent) in powers)
+            terms.append(Term(coefficient, powers))
+        return cls(terms=terms)
+
+    def get_variables(self):
+        variables = set()
+        for term in self.terms:
+            for atom, exponent in term.powers:
+                if isinstance(atom, str):
+                    variables.add(atom)
                 else:
-                    result.append([ex])
-            else:
-                result.append([co])
-            removeall(split, matchings)
-            i += 1
-        return joinlist(result, OPERATORS['+'])
-
-    def _remove_zeroes(self, exp):
-        return joinlist(filter(lambda x: self.get_coefficient(x) != 0,
-                               self.tokenize_terms(exp)), OPERATORS['+'])
-        
-    def _remove_constants(self, exp):
-        return joinlist(filter(lambda x: len(list(filter(lambda y: isinstance(y, str), x))) != 0,
-                               self.tokenize_terms(exp)), OPERATORS['+'])
-##        split = self.tokenize_terms(exp)
-##        if len(split) <= 0:
-##            return list()
-##        elif len(split) == 1:
-##            remove = True
-##            for c in split[0]:
-##                if isinstance(c, str):
-##                    remove = False
-##                    break
-##            return list() if remove else split[0]
-##        else:
-##            return joinlist([self._remove_constants(x) for x in split], OPERATORS['+'])
-
-    def _power_rule(self, exp):
-        split = self.tokenize_terms(exp)
-        if len(split) <= 0:
-            return list()
-        elif len(split) == 1:
-            data = split[0]
-            i = 0
-            while i < len(data):
-                if isinstance(data[i], str):
-                    if i + 2 < len(data):
-                        if data[i + 1] == OPERATORS['^']:
-                            power = data[i + 2]
-                            data[i + 2] -= 1
-                            if data[i + 2] == 1:
-                                del data[i + 2]
-                                del data[i + 1]
-                            if i - 1 >= 0 and data[i - 1] == OPERATORS['*']\
-                               and isinstance(data[i - 2], int):
-                                data[i - 2] *= power
-                                i += 1
-                            else:
-                                data.insert(i, OPERATORS['*'])
-                                data.insert(i, power)
-                                i += 2
-                        else:
-                            del data[i]
-                            del data[i]
-                    elif i - 1 >= 0:
-                        if data[i - 1] == OPERATORS['*'] and isinstance(data[i - 2], int):
-                            del data[i - 1]
-                            del data[i - 1]
-                    else:
-                        data[i] = 1
-                i += 1
-            return data
-        else:
-            return joinlist([self._power_rule(x) for x in split], OPERATORS['+'])
+                    variables.update(atom.get_variables())
+        return variables
+
+    @staticmethod
+    def _collect(terms):
+        collected = dict()
+        for term in terms:
+            collected[term.powers] = collected.get(term.powers, 0) + term.coefficient
+        return collected
 
-    def differentiate(self):
-        return Expression(data=
-                          self._power_rule(
-                              self._remove_constants(self.data[:])))
+    def evaluate(self, **kwargs):
+        numpy = array_module(kwargs.values())
+        if numpy is not None:
+            return self._evaluate_array(numpy, **kwargs)
+        terms = [term.substitute(kwargs) for term in self.terms]
+        if any(term.powers for term in terms):
+            return Expression(terms=terms)
+        result = 0
+        for term in terms:
+            result = OPERATORS['+'](result, term.coefficient)
+        return normalize(result)
 
     @staticmethod
-    def _exp_to_str(exp):
-        result = str()
-        for i in exp:
-            result += ' '
-            if isinstance(i, str):
-                result += i
-            elif i in OPERATORS.values():
-                for key, value in OPERATORS.items():
-                    if value == i:
-                        result += key
-                        break
+    def _number_source(value, names):
+        # Numbers are bound as named constants, see compile(), so rationals
+        # have no literal to write and ints too long for repr() still work
+        key = (type(value), value)
+        if key not in names:
+            names[key] = f'_k{len(names)}'
+        return names[key]
+
+    @classmethod
+    def _term_source(cls, term, names, lines):
+        factors = list()
+        for atom, exponent in term.powers:
+            if atom not in names:
+                # Each distinct sub-expression is computed once, ahead of use
+                names[atom] = atom._sum_source(None, names, lines)
+            factor = names[atom]
+            factors.append(factor if exponent == 1
+                           else f'_pow({factor}, {cls._number_source(exponent, names)})')
+        source = cls._number_source(term.coefficient, names)
+        if factors and term.coefficient == 1 and isinstance(term.coefficient, int):
+            source = factors.pop(0)
+        for factor in factors:
+            source = f'_mul({source}, {factor})'
+        return source
+
+    def _sum_source(self, target, names, lines):
+        # A flat statement per term keeps the generated code shallow however
+        # many terms there are
+        sources = [self._term_source(term, names, lines) for term in self.terms]
+        if target is None:
+            target = f'_g{len(names)}'
+        lines.append(f'    {target} = 0')
+        lines.extend(f'    {target} = _add({target}, {source})' for source in sources)
+        return target
+
+    def _compile_source(self):
+        names = {v: f'_v{i}' for i, v in enumerate(sorted(self.get_variables()))}
+        lines = ['def _compiled(**_kwargs):']
+        lines.extend(f'    {name} = _kwargs[{v!r}]' for v, name in names.items())
+        self._sum_source('_result', names, lines)
+        lines.append('    return _result')
+        constants = {name: key[1] for key, name in names.items() if isinstance(key, tuple)}
+        return '\n'.join(lines), constants
+
+    def compile(self, operators=OPERATORS, exact=True):
+        key = (id(operators), exact)
+        if key not in self._compiled:
+            source, constants = self._compile_source()
+            namespace = {name: operators[symbol] for symbol, name in OPERATOR_NAMES.items()}
+            if exact and operators is OPERATORS:
+                # Exact inputs stay exact, the same as evaluate()
+                namespace['_pow'] = power
+            namespace.update((name, value if exact else float(value))
+                             for name, value in constants.items())
+            exec(source, namespace)
+            self._compiled[key] = namespace['_compiled']
+        return self._compiled[key]
+
+    def equivalent(self, other, samples=16, tolerance=1e-9):
+        # Compare both sides at random points; only fall back to comparing
+        # canonical forms when too few points give finite values on both sides
+        variables = sorted(self.get_variables() | other.get_variables())
+        if not variables:
+            return self == other
+        points = {v: [random.uniform(-4, 4) for i in range(samples)] for v in variables}
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            arrays = {v: numpy.array(values) for v, values in points.items()}
+            try:
+                with numpy.errstate(all='ignore'):
+                    mine = self.evaluate(**arrays)
+                    theirs = other.evaluate(**arrays)
+            except (ValueError, ArithmeticError):
+                # Constants too large for a float can't be compared this way
+                return False
+            finite = numpy.isfinite(mine) & numpy.isfinite(theirs)
+            agree = numpy.isclose(mine[finite], theirs[finite], rtol=tolerance, atol=tolerance)
+            matches, finite_count = int(agree.sum()), int(finite.sum())
+        else:
+            matches = finite_count = 0
+            for i in range(samples):
+                values = {v: points[v][i] for v in variables}
+                try:
+                    mine = float(self.compile()(**values))
+                    theirs = float(other.compile()(**values))
+                except (ValueError, ArithmeticError):
+                    continue
+                if math.isfinite(mine) and math.isfinite(theirs):
+                    finite_count += 1
+                    matches += math.isclose(mine, theirs, rel_tol=tolerance, abs_tol=tolerance)
+        if matches < finite_count:
+            return False
+        if finite_count * 2 >= samples:
+            return True
+        return self == other
+
+    def _evaluate_array(self, numpy, **kwargs):
+        # Same operator table as the scalar path, swapped for broadcasting ufuncs
+        result = self.compile(ARRAY_OPERATORS, exact=False)(**kwargs)
+        shape = numpy.broadcast(*kwargs.values()).shape
+        if numpy.shape(result) != shape:
+            result = numpy.full(shape, result, dtype=float)
+        return result
+
+    def _distribute(self, terms):
+        # c * (a + b) on its own is just c * a + c * b
+        for term in terms:
+            if len(term.powers) == 1 and term.powers[0][1] == 1\
+               and not isinstance(term.powers[0][0], str):
+                for t in term.powers[0][0].terms:
+                    yield Term(term.coefficient * t.coefficient, t.powers)
+            else:
+                yield term
+
+    def _like_terms(self, terms):
+        return (Term(normalize(coefficient), powers)
+                for powers, coefficient in self._collect(terms).items())
+
+    def _remove_zeroes(self, terms):
+        return (term for term in terms if term.coefficient != 0)
+
+    def _remove_constants(self, terms, variable):
+        return (term for term in terms if term.depends_on(variable))
+
+    def _power_rule(self, terms, variable, memo):
+        def atom_derivative(atom):
+            # Sub-expressions repeated across terms are differentiated once
+            if atom not in memo:
+                # Built as a list before collecting, which keeps the stack
+                # shallow however deeply the sub-expressions nest
+                terms = list(atom._derivative_terms(variable, memo))
+                memo[atom] = Expression(terms=atom._collected_terms(terms))
+            return memo[atom]
+        return (d for term in terms for d in term.derivative(variable, atom_derivative))
+
+    def get_variable(self):
+        variables = self.get_variables()
+        if len(variables) > 1:
+            raise ValueError(f'Ambiguous variable: {", ".join(sorted(variables))}')
+        return variables.pop() if variables else 'x'
+
+    def differentiate(self, var=None, order=1):
+        if order < 1:
+            return Expression(terms=list(self.terms))
+        return self.derivatives(var, order)[-1]
+
+    def derivatives(self, var=None, order=1):
+        # Each order starts from the previous one's simplified form, and the
+        # memo carries sub-expression derivatives over between orders
+        if var is None:
+            var = self.get_variable()
+        cache = CACHES.get('differentiate')
+        memo = dict()
+        results = list()
+        current = self
+        for i in range(order):
+            if cache is not None:
+                current = Expression(terms=list(cache(current.get_key(), var)))
+                current.collect_terms()
             else:
-                result += str(i)
-        return result.strip()
+                # The raw derivative streams straight into collecting like
+                # terms and is never held as a list of its own
+                current = Expression(
+                    terms=current._collected_terms(current._derivative_terms(var, memo)))
+            results.append(current)
+        return results
+
+    def gradient(self, variables=None):
+        if variables is None:
+            variables = sorted(self.get_variables())
+        return [self.differentiate(var) for var in variables]
+
+    def _derivative_terms(self, variable, memo):
+        return self._power_rule(
+            self._remove_constants(self.terms, variable), variable, memo)
 
     def __str__(self):
-        return self._exp_to_str(self.data)
+        if self._str is None:
+            result = str()
+            for term in self.terms:
+                if not result:
+                    result = str(term)
+                elif term.coefficient < 0:
+                    result += f' - {term.negate()}'
+                else:
+                    result += f' + {term}'
+            self._str = result or '0'
+        return self._str
+
+    def get_canonical(self):
+        if self._canonical is None:
+            # Distributed like collect_terms() does, so collecting an
+            # expression never changes its hash
+            collected = self._collect(self._distribute(self.terms))
+            self._canonical = tuple(sorted(((powers, normalize(coefficient))
+                                            for powers, coefficient in collected.items()
+                                            if coefficient != 0),
+                                           key=lambda item: powers_key(item[0]), reverse=True))
+        return self._canonical
+
+    def get_sort_key(self):
+        if self._sort_key is None:
+            self._sort_key = tuple((tuple(powers_key(powers)), coefficient)
+                                   for powers, coefficient in self.get_canonical())
+        return self._sort_key
 
     def __eq__(self, other):
         if isinstance(self, other.__class__):
-            equal = True
-            self_terms = self.tokenize_terms()
-            other_terms = other.tokenize_terms()
-            for self_term in self_terms:
-                if self_term in other_terms:
-                    other_terms.remove(self_term)
-                else:
-                    return False
-            return len(other_terms) == 0
+            return self.get_canonical() == other.get_canonical()
         return False
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.get_canonical())
+        return self._hash
+
+    def __reduce__(self):
+        return (loads, (dumps(self),))
+
+def jacobian(expressions, variables=None):
+    if variables is None:
+        variables = sorted(set().union(*(y.get_variables() for y in expressions)))
+    return [y.gradient(variables) for y in expressions]
+
+class IncrementalParser:
+    # Parser state for a line that is edited a keystroke at a time. Tokens
+    # before the edit point are kept and only the rest of the line is lexed
+    # again, and top-level terms whose tokens did not change are not parsed again
+    def __init__(self, text=''):
+        self.text = ''
+        self.tokens = list()
+        # Offset of the end of each token, implicit multiplications end where
+        # the token after them starts
+        self.ends = list()
+        self.segments = dict()
+        self.error = None
+        self.result = None
+        self.edit(0, text)
+
+    def edit(self, position, inserted='', deleted=0):
+        text = self.text[:position] + inserted + self.text[position + deleted:]
+        # A token ending at the edit point can still grow, as in 12 -> 123
+        i = bisect.bisect_left(self.ends, position)
+        del self.tokens[i:], self.ends[i:]
+        self.error = None
+        self.result = None
+        start = self.ends[-1] if self.ends else 0
+        for match in TOKEN_PATTERN.finditer(text, start):
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == NUMBER:
+                value = Fraction(value) if '.' in value else int(value)
+            elif kind == 'error':
+                self.error = ValueError(f'Unexpected character: {value}')
+                break
+            if (kind == VARIABLE or value == '(') and self.tokens and\
+               (self.tokens[-1].kind in (NUMBER, VARIABLE) or self.tokens[-1].value == ')'):
+                self.tokens.append(Token(OPERATOR, '*'))
+                self.ends.append(match.start(match.lastgroup))
+            self.tokens.append(Token(kind, value))
+            self.ends.append(match.end())
+        # Lexing stops at a bad character, the next edit picks up from there
+        self.text = text
+
+    def update(self, text, cursor):
+        # Works out the edit from the new text and the cursor after a keystroke:
+        # typing leaves the cursor after the inserted text, and both backspace
+        # and delete leave it where the removed text was
+        if text == self.text:
+            return
+        grown = len(text) - len(self.text)
+        position = cursor - grown if grown > 0 else cursor
+        if 0 <= position <= len(self.text)\
+           and text[:position] == self.text[:position]\
+           and text[position + max(grown, 0):] == self.text[position - min(grown, 0):]:
+            self.edit(position, text[position:position + max(grown, 0)], max(-grown, 0))
+        else:
+            self.edit(0, text, len(self.text))
+
+    def _split(self):
+        # Top-level terms, split on the binary + and - outside parentheses
+        segments = list()
+        current = list()
+        depth = 0
+        for i, token in enumerate(self.tokens):
+            if token.kind == PAREN:
+                depth += 1 if token.value == '(' else -1
+                if depth < 0:
+                    raise ValueError('Unexpected token: )')
+            elif depth == 0 and token.value in ('+', '-') and current and\
+                 (current[-1].kind in (NUMBER, VARIABLE) or current[-1].value == ')'):
+                segments.append(current)
+                current = [token]
+                continue
+            current.append(token)
+        if current:
+            segments.append(current)
+        return segments
+
+    def expression(self):
+        # Parsed once per edit, however often it is asked for
+        if self.result is None:
+            try:
+                self.result = self._parse()
+            except (ValueError, ArithmeticError) as e:
+                self.result = e
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+    def _parse(self):
+        if self.error is not None:
+            raise self.error
+        check_nesting(self.tokens)
+        segments = dict()
+        terms = list()
+        for tokens in self._split():
+            # A leading + is only allowed between terms, so the first term is
+            # cached apart from the others
+            key = (not terms, tuple(tokens))
+            if key not in self.segments:
+                sign = '+'
+                if terms:
+                    sign, tokens = tokens[0].value, tokens[1:]
+                if not tokens:
+                    raise ValueError('Expression ends with an operator')
+                term, i = Expression._parse_product(tokens, 0)
+                if i < len(tokens):
+                    raise ValueError(f'Unexpected token: {tokens[i].value}')
+                self.segments[key] = term.negate() if sign == '-' else term
+            segments[key] = self.segments[key]
+            terms.append(segments[key])
+        # Only the terms still on the line are kept for the next edit
+        self.segments = segments
+        expression = Expression(terms=terms)
+        expression.collect_terms()
+        return expression
+
+    def is_valid(self):
+        try:
+            self.expression()
+        except (ValueError, ArithmeticError):
+            return False
+        return True
+
+def _differentiate_text(text, var=None, order=1, return_exceptions=False):
+    # Results cross process boundaries as plain strings
+    if not text.strip():
+        return ''
+    try:
+        return str(Expression(parse=text).differentiate(var, order))
+    except (ValueError, ArithmeticError, RecursionError) as e:
+        # One bad line is reported in place instead of ending the stream
+        if return_exceptions:
+            return e
+        raise
+
+def differentiate_many(iterable, workers=1, chunksize=256, var=None, order=1,
+                       return_exceptions=False):
+    derive = functools.partial(_differentiate_text, var=var, order=order,
+                               return_exceptions=return_exceptions)
+    if workers <= 1:
+        yield from map(derive, iterable)
+        return
+    import multiprocessing
+    iterator = iter(iterable)
+    with multiprocessing.Pool(workers) as pool:
+        # Feed the pool one bounded slice at a time so memory stays flat
+        # however long the input is
+        while True:
+            chunk = list(itertools.islice(iterator, workers * chunksize))
+            if not chunk:
+                break
+            yield from pool.imap(derive, chunk, chunksize)
+
+def _cached_collect_terms(key):
+    return tuple(Expression.from_key(key)._collected_terms())
+
+def _cached_differentiate(key, variable):
+    return tuple(Expression.from_key(key)._derivative_terms(variable, dict()))
+
+def enable_cache(maxsize=4096):
+    CACHES['collect_terms'] = functools.lru_cache(maxsize)(_cached_collect_terms)
+    CACHES['differentiate'] = functools.lru_cache(maxsize)(_cached_differentiate)
+
+def disable_cache():
+    CACHES.clear()
+
+def cache_info():
+    return {name: cache.cache_info() for name, cache in CACHES.items()}
+
+def _profiled(name, function):
+    # Items are what the stage produces: tokens for tokenize, terms otherwise.
+    # Streamed stages are timed while their terms are pulled, which includes
+    # the stages feeding them, the same way recursion in _power_rule counts
+    # nested time again
+    stats = PROFILE[name] = {'calls': 0, 'seconds': 0.0, 'items': 0}
+    def timed(iterator):
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                stats['seconds'] += time.perf_counter() - start
+            stats['items'] += 1
+            yield item
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        stats['seconds'] += time.perf_counter() - start
+        stats['calls'] += 1
+        if isinstance(result, list):
+            stats['items'] += len(result)
+            return result
+        return timed(iter(result))
+    return wrapper
+
+def enable_profiling():
+    # The stages are swapped for timed wrappers only while profiling, so the
+    # normal path runs the original functions untouched. Worker processes
+    # started by differentiate_many() are not profiled
+    disable_profiling()
+    PROFILE.clear()
+    UNPROFILED['tokenize'] = tokenize
+    globals()['tokenize'] = _profiled('tokenize', tokenize)
+    for stage in PROFILED_STAGES:
+        original = UNPROFILED[stage] = Expression.__dict__[stage]
+        if isinstance(original, classmethod):
+            setattr(Expression, stage, classmethod(_profiled(stage, original.__func__)))
+        else:
+            setattr(Expression, stage, _profiled(stage, original))
+
+def disable_profiling():
+    # Counters are kept so they can still be read after a profiled run
+    if 'tokenize' in UNPROFILED:
+        globals()['tokenize'] = UNPROFILED.pop('tokenize')
+    for stage in PROFILED_STAGES:
+        if stage in UNPROFILED:
+            setattr(Expression, stage, UNPROFILED.pop(stage))
+
+def profile_info():
+    return {name: dict(stats) for name, stats in PROFILE.items()}
+
+def log_profile(logger=None, level=None):
+    import logging
+    if logger is None:
+        logger = logging.getLogger('quickderiv')
+    for name, stats in PROFILE.items():
+        logger.log(logging.INFO if level is None else level,
+                   f'{name}: {stats["calls"]} calls, {stats["seconds"] * 1e3:.3f} ms, '
+                   f'{stats["items"]} items')
+
+class Profiling:
+    # with Profiling() as stats: ... profiles the block, stats fill in as it runs
+    def __enter__(self):
+        enable_profiling()
+        return PROFILE
+
+    def __exit__(self, *exc_info):
+        disable_profiling()
+
+def dumps_many(expressions):
+    # One opcode per number or atom in a byte array, with counts and integers
+    # in an int64 array, floats in a double array and names in a string table.
+    # Sub-expressions shared between terms are written once and referenced
+    opcodes = array('B')
+    ints = array('q')
+    floats = array('d')
+    strings = dict()
+    groups = dict()
+    def write_string(text):
+        if text not in strings:
+            strings[text] = len(strings)
+        ints.append(strings[text])
+    def write_number(value):
+        if isinstance(value, float):
+            opcodes.append(OP_FLOAT)
+            floats.append(value)
+        elif isinstance(value, Fraction):
+            opcodes.append(OP_RATIONAL)
+            write_number(value.numerator)
+            write_number(value.denominator)
+        elif -2 ** 63 <= value < 2 ** 63:
+            opcodes.append(OP_INT)
+            ints.append(value)
+        else:
+            opcodes.append(OP_BIGINT)
+            write_string(str(value))
+    def write_expression(y):
+        ints.append(len(y.terms))
+        for term in y.terms:
+            write_number(term.coefficient)
+            ints.append(len(term.powers))
+            for atom, exponent in term.powers:
+                if isinstance(atom, str):
+                    opcodes.append(OP_VARIABLE)
+                    write_string(atom)
+                elif id(atom) in groups:
+                    opcodes.append(OP_GROUP_REF)
+                    ints.append(groups[id(atom)])
+                else:
+                    opcodes.append(OP_GROUP)
+                    groups[id(atom)] = len(groups)
+                    write_expression(atom)
+                write_number(exponent)
+    count = 0
+    for y in expressions:
+        write_expression(y)
+        count += 1
+    if sys.byteorder == 'big':
+        ints.byteswap()
+        floats.byteswap()
+    table = '\0'.join(strings).encode('utf-8')
+    return b''.join((FORMAT_HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, count,
+                                        len(opcodes), len(ints), len(floats)),
+                     opcodes.tobytes(), ints.tobytes(), floats.tobytes(), table))
+
+def loads_many(data):
+    # Accepts any buffer, such as bytes, a memoryview or an mmap
+    data = memoryview(data)
+    magic, version, count, opcode_count, int_count, float_count =\
+        FORMAT_HEADER.unpack_from(data)
+    if magic != FORMAT_MAGIC or version != FORMAT_VERSION:
+        raise ValueError('Not a quickderiv expression buffer')
+    offset = FORMAT_HEADER.size
+    opcodes = bytes(data[offset:offset + opcode_count])
+    offset += opcode_count
+    ints = array('q')
+    ints.frombytes(data[offset:offset + int_count * ints.itemsize])
+    offset += int_count * ints.itemsize
+    floats = array('d')
+    floats.frombytes(data[offset:offset + float_count * floats.itemsize])
+    offset += float_count * floats.itemsize
+    if sys.byteorder == 'big':
+        ints.byteswap()
+        floats.byteswap()
+    strings = str(data[offset:], 'utf-8').split('\0')
+    next_opcode = iter(opcodes).__next__
+    next_int = iter(ints.tolist()).__next__
+    next_float = iter(floats.tolist()).__next__
+    groups = list()
+    def read_number():
+        opcode = next_opcode()
+        if opcode == OP_INT:
+            return next_int()
+        if opcode == OP_FLOAT:
+            return next_float()
+        if opcode == OP_RATIONAL:
+            return Fraction(read_number(), read_number())
+        return int(strings[next_int()])
+    def read_expression():
+        terms = list()
+        for i in range(next_int()):
+            coefficient = read_number()
+            powers = list()
+            for j in range(next_int()):
+                opcode = next_opcode()
+                if opcode == OP_VARIABLE:
+                    atom = strings[next_int()]
+                elif opcode == OP_GROUP_REF:
+                    atom = groups[next_int()]
+                else:
+                    index = len(groups)
+                    groups.append(None)
+                    atom = groups[index] = read_expression()
+                powers.append((atom, read_number()))
+            terms.append(Term(coefficient, tuple(powers)))
+        return Expression(terms=terms)
+    return [read_expression() for i in range(count)]
+
+def dumps(expression):
+    return dumps_many((expression,))
+
+def loads(data):
+    return loads_many(data)[0]
@@ -1,9 +1,10 @@
-import random, logging, math, sys, os
+import random, logging, math, sys, os, threading, time, csv, json, struct
 from os import path
 from datetime import datetime, timedelta
-from expressions import Expression
+from expressions import Expression, IncrementalParser, enable_profiling, disable_profiling, log_profile,\
+                        dumps_many, loads_many
 from pygame.locals import Color
-from collections import namedtuple
+from collections import deque, namedtuple
 try:
     import pygame, pygame_textinput, ptext
 except ImportError as e:
@@ -12,12 +13,36 @@ except ImportError as e:
     pygame = None
     pygame_textinput = None
     ptext = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 WHITE = Color('white')
 FOREGROUND_COLOR = (0, 255, 0)
+INVALID_COLOR = (255, 80, 80)
 BACKGROUND_COLOR = Color('black')
 MUSIC_VOLUME = 0.75
 QUESTION_LENGTH = 20
+# Questions kept ready ahead of the one on screen
+QUESTION_BANK_DEPTH = 16
+# Parts of a frame timed by the frame profiler, update is whatever a state
+# does outside the sections it marks itself
+FRAME_SECTIONS = ('events', 'answer', 'question', 'background', 'stars', 'lines', 'bar',
+                  'glitch_text', 'text', 'input_box', 'fade', 'update', 'overlay',
+                  'display', 'tick')
+# pygame functions and methods that return a new surface, by the module or
+# type they belong to. Surfaces made by calling pygame.Surface directly are
+# counted separately, see FrameProfiler.begin_frame()
+SURFACE_FACTORIES = {
+
+    'pygame.transform': frozenset(('scale', 'smoothscale', 'rotate', 'rotozoom', 'flip',
+                                   'scale2x', 'chop', 'laplacian')),
+    'pygame.image': frozenset(('load', 'frombuffer', 'fromstring', 'frombytes')),
+    'pygame.surface.Surface': frozenset(('copy', 'convert', 'convert_alpha', 'subsurface')),
+    'pygame.font.Font': frozenset(('render',))
+
+}
 TWO_PI = math.pi * 2
 
 def getfile(filename):
@@ -36,6 +61,11 @@ def removeif(pred, data):
         else:
             i += 1
             
+def text_rect(drawn):
+    # ptext.draw returns the rendered surface and where it went
+    surface, position = drawn
+    return pygame.Rect(position, surface.get_size())
+
 def distance(x, y, x2, y2):
     return math.hypot(x - x2, y - y2)
 
@@ -45,6 +75,7 @@ logging.basicConfig(
 logger = logging.getLogger('quickderiv-game')
 disco_dech_chrome = getfile('discodeckchrome.ttf')
 blood_dragon_theme = getfile('blood-dragon-theme.mp3')
+question_bank = getfile('questions.bank')
 Question = namedtuple('Question', 'y y_prime')
 
 class Audio:
@@ -53,6 +84,185 @@ class Audio:
         self.select = pygame.mixer.Sound(getfile('select.wav'))
         self.bad = pygame.mixer.Sound(getfile('bad.wav'))
 
+class QuestionBank:
+    def __init__(self, make_question, depth=QUESTION_BANK_DEPTH):
+        self.make_question = make_question
+        self.depth = depth
+        self.questions = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        # Questions are made on a background thread, so the frame after a
+        # correct answer only takes one off the queue. A depth of 0 makes
+        # every question on the spot instead
+        if self.thread is None and self.depth > 0:
+            self.thread = threading.Thread(target=self._fill, name='question-bank', daemon=True)
+            self.thread.start()
+
+    def _fill(self):
+        while True:
+            with self.condition:
+                while len(self.questions) >= self.depth:
+                    self.condition.wait()
+            question = self.make_question()
+            with self.condition:
+                self.questions.append(question)
+
+    def pop(self):
+        with self.condition:
+            if self.questions:
+                self.condition.notify()
+                return self.questions.popleft()
+        # Nothing ready yet, make one on the spot
+        return self.make_question()
+
+    def load(self, filename):
+        # A stale or damaged bank is skipped, questions are then made as needed
+        try:
+            with open(filename, 'rb') as f:
+                expressions = loads_many(f.read())
+        except (OSError, ValueError, struct.error, IndexError, StopIteration) as e:
+            logger.warning(f'Could not load questions from {filename}: {e!r}')
+            return
+        questions = [Question(y, y_prime) for y, y_prime in zip(expressions[::2], expressions[1::2])]
+        random.shuffle(questions)
+        with self.condition:
+            self.questions.extend(questions)
+        logger.info(f'Loaded {len(questions)} questions from {filename}')
+
+    def save(self, filename, count=1000):
+        questions = [self.make_question() for i in range(count)]
+        with open(filename, 'wb') as f:
+            f.write(dumps_many(e for question in questions for e in question))
+
+class FrameProfiler:
+    def __init__(self, window=300):
+        self.running = False
+        self.overlay = False
+        self.count_surfaces = False
+        self.totals = deque(maxlen=window)
+        self.sections = dict.fromkeys(FRAME_SECTIONS, 0.0)
+        self.surfaces = 0
+        self.counted_surface = None
+        self.frame = 0
+        # Start of the current section, None outside a profiled frame
+        self.last = None
+        self.log = None
+        self.writer = None
+
+    def start(self, filename=None, count_surfaces=False):
+        # Logs to CSV or, for any other extension, one JSON object per line.
+        # Counting surfaces watches every call made during the frame, which
+        # slows the frame down, so it is off unless asked for
+        self.stop()
+        self.running = True
+        self.count_surfaces = count_surfaces
+        self.totals.clear()
+        self.frame = 0
+        if filename is not None:
+            self.log = open(filename, 'w', newline='')
+            if filename.endswith('.csv'):
+                self.writer = csv.DictWriter(
+                    self.log, ('frame', 'total') + FRAME_SECTIONS + ('surfaces',))
+                self.writer.writeheader()
+
+    def stop(self):
+        self.running = False
+        self.overlay = False
+        if self.log is not None:
+            self.log.close()
+        self.log = None
+        self.writer = None
+
+    def toggle_overlay(self):
+        if not self.running:
+            self.start()
+        self.overlay = not self.overlay
+
+    def begin_frame(self):
+        if not self.running:
+            return
+        for section in self.sections:
+            self.sections[section] = 0.0
+        self.surfaces = 0
+        if self.count_surfaces:
+            # The profile hook never sees a type being called, so for the
+            # frame pygame.Surface is swapped for a subclass that counts itself
+            pygame.Surface = self._counted_surface()
+            sys.setprofile(self._count)
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, section):
+        # Time since the previous mark goes to this section
+        if self.last is None:
+            return
+        now = time.perf_counter()
+        self.sections[section] += now - self.last
+        self.last = now
+
+    def end_frame(self):
+        if self.last is None:
+            return
+        if pygame.Surface is not pygame.surface.Surface:
+            sys.setprofile(None)
+            pygame.Surface = pygame.surface.Surface
+        total = time.perf_counter() - self.started
+        self.last = None
+        self.totals.append(total)
+        self.frame += 1
+        if self.log is not None:
+            row = {'frame': self.frame, 'total': total, **self.sections, 'surfaces': self.surfaces}
+            if self.writer is not None:
+                self.writer.writerow(row)
+            else:
+                self.log.write(json.dumps(row) + '\n')
+
+    def _counted_surface(self):
+        if self.counted_surface is None:
+            profiler = self
+            class CountedSurface(pygame.surface.Surface):
+                def __init__(self, *args, **kwargs):
+                    profiler.surfaces += 1
+                    super().__init__(*args, **kwargs)
+            self.counted_surface = CountedSurface
+        return self.counted_surface
+
+    def _count(self, frame, event, arg):
+        if event != 'c_call':
+            return
+        owner = getattr(arg, '__self__', None)
+        if isinstance(owner, type(sys)):
+            owners = (owner.__name__,)
+        else:
+            # Methods of counted surfaces belong to pygame.Surface all the same
+            owners = (f'{cls.__module__}.{cls.__name__}' for cls in type(owner).__mro__)
+        if any(arg.__name__ in SURFACE_FACTORIES.get(owner, ()) for owner in owners):
+            self.surfaces += 1
+
+    def percentiles(self, points=(50, 95, 99)):
+        # Over the last window of frames
+        totals = sorted(self.totals)
+        if not totals:
+            return dict.fromkeys(points, 0.0)
+        return {p: totals[min(len(totals) * p // 100, len(totals) - 1)] for p in points}
+
+    def draw_overlay(self, screen):
+        lines = ['  '.join(f'p{p} {seconds * 1e3:.2f} ms'
+                           for p, seconds in self.percentiles().items())]
+        slowest = sorted(self.sections.items(), key=lambda item: item[1], reverse=True)
+        lines.extend(f'{section:<12} {seconds * 1e3:6.2f} ms' for section, seconds in slowest[:5])
+        if self.count_surfaces:
+            lines.append(f'surfaces     {self.surfaces}')
+        ptext.draw('\n'.join(lines), topleft=(10, 10), fontsize=20,
+                   color=WHITE, background=BACKGROUND_COLOR, surf=screen)
+
+# Shared by the game loop and the states that mark sections of their update
+frame_profiler = FrameProfiler()
+
+def make_question_bank(filename=question_bank, count=1000):
+    QuestionBank(PlayingState._make_question).save(filename, count)
+
 class Star:
     def __init__(self, x, y, x_speed, y_speed, size=1):
         self.x = x
@@ -62,6 +272,7 @@ class Star:
 
     def draw(self, surface, color=FOREGROUND_COLOR):
         surface.set_at((int(self.x), int(self.y)), color)
+        return pygame.Rect(int(self.x), int(self.y), 1, 1)
 
     def update(self, surface_width, surface_height, correct_delta):
         mul = max(4 - correct_delta.total_seconds(), 0)
@@ -69,12 +280,88 @@ class Star:
         self.y -= mul * surface_height / abs(surface_height - self.y)
         return self.y < 0 or self.y > surface_height or self.x < 0 or self.x > surface_width
 
+class StarList:
+    # One Star object per star, used when numpy is not installed
+    def __init__(self):
+        self.stars = list()
+
+    def add(self, x, y, x_speed):
+        self.stars.append(Star(x, y, x_speed, 0))
+
+    def clear(self):
+        self.stars.clear()
+
+    def draw(self, surface, color=FOREGROUND_COLOR):
+        # Returns the area drawn over, or None when there are no stars
+        rects = [star.draw(surface, color) for star in self.stars]
+        return rects[0].unionall(rects[1:]) if rects else None
+
+    def update(self, surface_width, surface_height, correct_delta):
+        removeif(lambda x: x.update(surface_width, surface_height, correct_delta), self.stars)
+
+    def __len__(self):
+        return len(self.stars)
+
+class StarField:
+    # Stars held in preallocated numpy columns, moved and culled with array
+    # operations and drawn with one write into the surface pixels. Same motion
+    # as Star
+    def __init__(self, capacity=1024):
+        self.x = numpy.empty(capacity)
+        self.y = numpy.empty(capacity)
+        self.x_speed = numpy.empty(capacity)
+        self.count = 0
+
+    def add(self, x, y, x_speed):
+        if self.count == len(self.x):
+            for name in ('x', 'y', 'x_speed'):
+                column = numpy.empty(self.count * 2)
+                column[:self.count] = getattr(self, name)
+                setattr(self, name, column)
+        self.x[self.count] = x
+        self.y[self.count] = y
+        self.x_speed[self.count] = x_speed
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def draw(self, surface, color=FOREGROUND_COLOR):
+        x = self.x[:self.count].astype(int)
+        y = self.y[:self.count].astype(int)
+        # set_at ignored stars on the far edges, indexing would not
+        visible = (x >= 0) & (x < surface.get_width()) & (y >= 0) & (y < surface.get_height())
+        pixels = pygame.surfarray.pixels2d(surface)
+        x, y = x[visible], y[visible]
+        pixels[x, y] = surface.map_rgb(color)
+        del pixels
+        if not len(x):
+            return None
+        return pygame.Rect(int(x.min()), int(y.min()),
+                           int(x.max() - x.min()) + 1, int(y.max() - y.min()) + 1)
+
+    def update(self, surface_width, surface_height, correct_delta):
+        n = self.count
+        x, y, x_speed = self.x[:n], self.y[:n], self.x_speed[:n]
+        mul = max(4 - correct_delta.total_seconds(), 0)
+        x += x_speed * mul / 3
+        y -= mul * surface_height / numpy.abs(surface_height - y)
+        keep = (y >= 0) & (y <= surface_height) & (x >= 0) & (x <= surface_width)
+        self.count = int(keep.sum())
+        x[:self.count] = x[keep]
+        y[:self.count] = y[keep]
+        x_speed[:self.count] = x_speed[keep]
+
+    def __len__(self):
+        return self.count
+
 class HorizontalLine:
     def __init__(self, y, size=1):
         self.y = y
 
     def draw(self, surface, color=FOREGROUND_COLOR):
-        pygame.draw.line(surface, FOREGROUND_COLOR, (0, self.y), (surface.get_width(), self.y))
+        return pygame.draw.line(surface, FOREGROUND_COLOR,
+                                (0, self.y), (surface.get_width(), self.y))
 
     def update(self, surface_height, last_correct):
         if self.y >= surface_height:
@@ -113,6 +400,9 @@ class State:
         self.label = label
         self.previous_state = previous_state
         self.audio = audio
+        # Areas of the screen changed by the last update, None when the whole
+        # frame has to be pushed
+        self.dirty_rects = None
 
     def initialize(self):
         pass
@@ -329,13 +619,19 @@ class GameOverState(State):
 class PlayingState(State):
     def __init__(self, previous_state, resolution, audio):
         State.__init__(self, 'Play', previous_state, audio)
-        self.stars = list()
+        self.stars = StarField() if numpy is not None else StarList()
         self.lines = list()
+        self.background = None
         self.low_graphics = False
         self.inputbox = pygame_textinput.TextInput(
             before_string="y' = ",
             cursor_color=WHITE,
             text_color=WHITE)
+        self.answer = IncrementalParser()
+        self.bank = QuestionBank(self._make_question, QUESTION_BANK_DEPTH)
+        if os.path.exists(question_bank):
+            self.bank.load(question_bank)
+        self.bank.start()
         self.fade = Fade(resolution)
         self.initialize()
 
@@ -344,7 +640,8 @@ class PlayingState(State):
             now = datetime.now()
         return now + timedelta(seconds=seconds)
 
-    def _make_question_part(self):
+    @staticmethod
+    def _make_question_part():
         part = random.randint(0, 5)
         if part == 0:
             return str(random.randint(1, 20))
@@ -357,8 +654,9 @@ class PlayingState(State):
         else:
             return f'x ^ {random.randint(2, 5)}'
 
-    def _make_question(self):
-        exp = Expression(parse=' + '.join([self._make_question_part() for i in range(3)]))
+    @staticmethod
+    def _make_question():
+        exp = Expression(parse=' + '.join([PlayingState._make_question_part() for i in range(3)]))
         der = exp.differentiate()
         der.collect_terms()
         return Question(exp, der)
@@ -369,12 +667,35 @@ class PlayingState(State):
         self.questions = [None]
         self.stars.clear()
         self.lines.clear()
+        self.previous_rects = None
         self.inputbox.clear_text()
+        self.answer = IncrementalParser()
         self.fade.reset()
         self.opening = True
         self.closing = False
         self.reset_times()
 
+    def _get_background(self, screen, width, height):
+        # The Y grid and horizon never move, so they are drawn once per
+        # resolution and blitted every frame
+        if self.background is None or self.background.get_size() != (width, height):
+            half_width = int(width / 2)
+            half_height = int(height / 2 - 1)
+            self.background = pygame.Surface((width, height), 0, screen)
+            self.background.fill(BACKGROUND_COLOR)
+
+            # Y grid
+            for i in range(-width * 100, half_width, 1000):
+                pygame.draw.line(self.background, FOREGROUND_COLOR,
+                                 (half_width, half_height), (i, height))
+                pygame.draw.line(self.background, FOREGROUND_COLOR,
+                                 (half_width, half_height), (width - i, height))
+
+            # Horizon
+            pygame.draw.line(self.background, FOREGROUND_COLOR,
+                             (0, half_height), (width, half_height))
+        return self.background
+
     def reset_times(self, now=None):
         if now is None:
             now = datetime.now()
@@ -384,13 +705,19 @@ class PlayingState(State):
     def update(self, events, screen, width, height):
         if not self.closing and not self.opening\
            and self.inputbox.update(events) and self.questions[-1]:
+            self.answer.update(self.inputbox.get_text(), self.inputbox.get_cursor_position())
             try:
-                entered = Expression(parse=self.inputbox.get_text())
-                entered.collect_terms()
+                entered = self.answer.expression()
             except:
                 entered = None
             self.inputbox.clear_text()
-            if entered == self.questions[-1].y_prime:
+            self.answer = IncrementalParser()
+            try:
+                correct = entered is not None and entered.equivalent(self.questions[-1].y_prime)
+            except (ValueError, ArithmeticError):
+                # An answer that cannot even be evaluated is just wrong
+                correct = False
+            if correct:
                 self.score += 1
                 logger.info(f"Answer correct: y' = {self.questions[-1][1]}")
                 self.questions.append(None)
@@ -402,28 +729,41 @@ class PlayingState(State):
             else:
                 logger.info(f'Answer incorrect')
                 self.audio.bad.play()
+        frame_profiler.mark('input_box')
+
+        # Live feedback while typing, only the edited part of the answer is parsed again
+        self.answer.update(self.inputbox.get_text(), self.inputbox.get_cursor_position())
+        self.inputbox.set_text_color(WHITE if self.answer.is_valid() else INVALID_COLOR)
+        frame_profiler.mark('answer')
 
         if not self.closing and not self.opening and self.next_time < datetime.now():
             logger.info(f"Timed out, the correct answer was: y' = {self.questions[-1][1]}")
             self.closing = True
 
         if not self.questions[-1]:
-            self.questions[-1] = self._make_question()
+            self.questions[-1] = self.bank.pop()
             logger.info(f'Question presented: y = {self.questions[-1][0]}')
+        frame_profiler.mark('question')
 
         half_width = int(width / 2)
         half_height = int(height / 2 - 1)
 
-        screen.fill(BACKGROUND_COLOR)
+        # Everything is drawn in the same colour, so stars and moving lines
+        # can go on top of the static grid
+        screen.blit(self._get_background(screen, width, height), (0, 0))
+        rects = list()
+        frame_profiler.mark('background')
 
         now = datetime.now()
         correct_delta = now - self.last_correct
 
         # Draw stars
-        for star in self.stars:
-            star.draw(screen)
-            
-        removeif(lambda x: x.update(width, height, now - self.last_correct), self.stars)
+        rect = self.stars.draw(screen)
+        # Stars stop moving once the burst is over and need no pushing then
+        if rect is not None and correct_delta.total_seconds() < 4:
+            rects.append(rect)
+        self.stars.update(width, height, now - self.last_correct)
+        frame_profiler.mark('stars')
 
         # X grid
         if not self.lines:
@@ -432,60 +772,60 @@ class PlayingState(State):
             self.lines.append(HorizontalLine(half_height + (half_height / 4), width))
             self.lines.append(HorizontalLine(half_height + (half_height / 8), width))
         for line in self.lines:
-            line.draw(screen)
+            rects.append(line.draw(screen))
             line.update(height, correct_delta)
-
-        # Y grid
-        for i in range(-width * 100, half_width, 1000):
-            pygame.draw.line(screen, FOREGROUND_COLOR, (half_width, half_height), (i, height))
-            pygame.draw.line(screen, FOREGROUND_COLOR,
-                             (half_width, half_height), (width - i, height))
-
-        # Horizon
-        pygame.draw.line(screen, FOREGROUND_COLOR, (0, half_height), (width, half_height))
+        frame_profiler.mark('lines')
 
         # Time left
         bar_length = width if self.opening else width * (
             self.next_time - datetime.now()).total_seconds() / self.question_length
-        screen.fill(FOREGROUND_COLOR, pygame.Rect(0, height - 10, int(bar_length), 10))
+        rects.append(screen.fill(FOREGROUND_COLOR, pygame.Rect(0, height - 10, int(bar_length), 10)))
+        frame_profiler.mark('bar')
 
         # Question 'glitchy' text
         if not self.low_graphics:
             for i in range(3):
-                ptext.draw(f'y = {self.questions[-1].y}',
-                           midtop=(half_width + random.randint(-5, 5),
-                                   (half_height / 2) + random.randint(-5, 5)),
-                           alpha=0.2,
-                           fontsize=54,
-                           surf=screen)
+                drawn = ptext.draw(f'y = {self.questions[-1].y}',
+                                   midtop=(half_width + random.randint(-5, 5),
+                                           (half_height / 2) + random.randint(-5, 5)),
+                                   alpha=0.2,
+                                   fontsize=54,
+                                   surf=screen)
+                rects.append(text_rect(drawn))
+        frame_profiler.mark('glitch_text')
                 
         # Question text
-        ptext.draw(f'y = {self.questions[-1].y}',
-                   midtop=(half_width, half_height / 2),
-                   fontsize=54,
-                   surf=screen)
+        drawn = ptext.draw(f'y = {self.questions[-1].y}',
+                           midtop=(half_width, half_height / 2),
+                           fontsize=54,
+                           surf=screen)
+        rects.append(text_rect(drawn))
 
         # Score text
-        ptext.draw(f'Score: {self.score}',
-                   midbottom=(half_width, (half_height / 2) - 10),
-                   surf=screen)
+        drawn = ptext.draw(f'Score: {self.score}',
+                           midbottom=(half_width, (half_height / 2) - 10),
+                           surf=screen)
+        rects.append(text_rect(drawn))
 
         # Input text
         intext = self.inputbox.get_surface()
-        screen.blit(intext, intext.get_rect(center=(width / 2, height / 2 - 30)))
+        rects.append(screen.blit(intext, intext.get_rect(center=(width / 2, height / 2 - 30))))
+        frame_profiler.mark('text')
+
+        # Only what was drawn this frame or the last one has changed, unless
+        # a fade covers the whole screen
+        fading = self.opening or self.closing
+        self.dirty_rects = None if fading or self.previous_rects is None\
+                           else rects + self.previous_rects
+        self.previous_rects = None if fading else rects
 
         # Add stars
         for i in range(int((0.5 if self.low_graphics else 2) *
                            max(4 - correct_delta.total_seconds(), 0))):
-            x_speed = random.uniform(-40, 40)
-            y_speed = random.uniform(2, 10)
-            self.stars.append(Star(half_width,
-                                   half_height,
-                                   x_speed,
-                                   abs(y_speed - abs(x_speed / 2)) + 1,
-                                   self))
+            self.stars.add(half_width, half_height, random.uniform(-40, 40))
 
         self.fade.blit_onto(screen)
+        frame_profiler.mark('fade')
         if self.opening:
             self.fade.fade_in()
             if self.fade.is_complete(True):
@@ -502,6 +842,35 @@ class PlayingState(State):
 def is_playable():
     return pygame and pygame_textinput and ptext
 
+def step(state, events, screen, width, height):
+    # One pass of the game loop without touching the display. Returns the
+    # next state, whether a frame was drawn and the areas it changed
+    toggled = False
+    for event in events:
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+            frame_profiler.toggle_overlay()
+            toggled = True
+        if event.type == pygame.QUIT:
+            return None, False, None
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            logger.info(f'Escaped state: {state} -> {state.previous_state}')
+            state.audio.bad.play()
+            state = state.previous_state
+            if state is not None:
+                state.initialize()
+            return state, False, None
+    frame_profiler.mark('events')
+    update = state.update(events, screen, width, height)
+    frame_profiler.mark('update')
+    # States that track what they drew push only those areas. Switching the
+    # overlay off needs one full push to clear it from the display
+    rects = None if toggled else state.dirty_rects
+    if state is not update:
+        logger.info(f'State: {state} -> {update}')
+        if update is not None:
+            update.initialize()
+    return update, bool(update), rects
+
 def play(resolution=(1080, 720), flags=0):
     pygame.init()
     pygame.mixer.init()
@@ -517,34 +886,41 @@ def play(resolution=(1080, 720), flags=0):
     pygame.mixer.music.set_volume(MUSIC_VOLUME)
     pygame.mixer.music.play(-1)
     state = MenuState(resolution, audio)
+    # QUICKDERIV_PROFILE=1 logs per-stage timings of the derivative engine on exit
+    profile = bool(os.environ.get('QUICKDERIV_PROFILE'))
+    if profile:
+        enable_profiling()
     logger.info('Game started')
+    # QUICKDERIV_FRAME_LOG=frames.csv logs the time each part of every frame
+    # takes, F3 shows the same timings over the game. QUICKDERIV_COUNT_SURFACES=1
+    # adds surface counts, at the cost of slowing every frame down
+    if os.environ.get('QUICKDERIV_FRAME_LOG'):
+        frame_profiler.start(os.environ['QUICKDERIV_FRAME_LOG'],
+                             count_surfaces=bool(os.environ.get('QUICKDERIV_COUNT_SURFACES')))
     while state:
-        events = pygame.event.get()
-        for event in events:
-            if event.type == pygame.QUIT:
-                state = None
-                break
-            elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
-                logger.info(f'Escaped state: {state} -> {state.previous_state}')
-                audio.bad.play()
-                state = state.previous_state
-                if state is not None:
-                    state.initialize()
-                break
-            
-        else:
-            update = state.update(events, screen, WIDTH, HEIGHT)
-            if state is not update:
-                logger.info(f'State: {state} -> {update}')
-                state = update
-                if state is not None:
-                    state.initialize()
-            if update:
+        frame_profiler.begin_frame()
+        state, updated, rects = step(state, pygame.event.get(), screen, WIDTH, HEIGHT)
+        if updated:
+            if frame_profiler.overlay:
+                # The overlay changes every frame, so it gets full updates
+                frame_profiler.draw_overlay(screen)
+                rects = None
+                frame_profiler.mark('overlay')
+            if rects is None:
                 pygame.display.update()
-                clock.tick_busy_loop(60)
+            else:
+                pygame.display.update(rects)
+            frame_profiler.mark('display')
+            clock.tick_busy_loop(60)
+            frame_profiler.mark('tick')
+        frame_profiler.end_frame()
 
+    frame_profiler.stop()
     pygame.mixer.quit()
     pygame.quit()
+    if profile:
+        disable_profiling()
+        log_profile(logger)
     logger.info('Game ended')
 
 def install_dependencies():
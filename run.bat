@@ -11,6 +11,7 @@ if exist build/exe.win32-3.6/quickderiv.exe (
 	quickderiv.exe
 ) else (
 	echo Build not found. Building with cx_Freeze
+	python -c "import game; game.make_question_bank()"
 	python setup.py build
 	echo Attempting to launch build.
 	echo.
@@ -14,7 +14,9 @@ cx_Freeze.setup(
                                              'quickderiv-title.png',
                                              'quickderiv-title-gradient.png',
                                              'select.wav',
-                                             'zap.wav']}},
+                                             'zap.wav'] +
+                                            # Made by game.make_question_bank(), see run.bat
+                                            [f for f in ['questions.bank'] if os.path.exists(f)]}},
     description='quickderiv - A calculus game by Rory Eckel',
     version='1.0',
     executables = [cx_Freeze.Executable('__main__.py',